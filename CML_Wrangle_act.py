@@ -6,7 +6,7 @@
 
 # ### Importing the necessary packages:
 
-# In[1]:
+# In[ ]:
 
 
 import tweepy
@@ -15,54 +15,363 @@ import pandas as pd
 import numpy as np
 import requests
 import json
+import os
+import shutil
+import pyarrow as pa
 from timeit import default_timer as timer
 
 
+# > Text columns (ids, text, urls, names...) are kept as Arrow strings instead of Python *str* objects. They use far less memory, and the dataframes can be handed to pyarrow without copying the data.
+
+# In[ ]:
+
+
+arrow_str = pd.StringDtype('pyarrow')
+
+# text columns of each file, read straight into Arrow strings
+arc_text_columns = ['timestamp', 'source', 'text', 'retweeted_status_timestamp', 'expanded_urls',
+                    'name', 'doggo', 'floofer', 'pupper', 'puppo']
+predict_text_columns = ['jpg_url', 'p1', 'p2', 'p3']
+
+
+# > I only want original ratings with images. The retweets, the replies and the tweets without photo are filtered **while reading** the archive and the JSON file, so these rows are never loaded into the dataframes.
+
+# In[ ]:
+
+
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.dataset as ds
+
+# types of the archive columns, so every block of the file is parsed the same way
+arc_column_types = {'tweet_id': pa.int64(), 'in_reply_to_status_id': pa.float64(), 'in_reply_to_user_id': pa.float64(),
+                    'retweeted_status_id': pa.float64(), 'retweeted_status_user_id': pa.float64(),
+                    'rating_numerator': pa.int64(), 'rating_denominator': pa.int64(),
+                    **dict.fromkeys(arc_text_columns, pa.string())}
+
+# not a retweet, not a reply, has a photo URL and a rating
+arc_filter = (ds.field('retweeted_status_id').is_null()
+              & ds.field('in_reply_to_status_id').is_null()
+              & pc.match_substring(ds.field('expanded_urls'), '/photo/')
+              & ds.field('rating_numerator').is_valid()
+              & ds.field('rating_denominator').is_valid())
+
+
+def read_archive(path):
+    # the filter is applied to each batch of parsed rows, before anything is converted to pandas
+    csv_format = ds.CsvFileFormat(parse_options=pv.ParseOptions(newlines_in_values=True),
+                                  convert_options=pv.ConvertOptions(column_types=arc_column_types, strings_can_be_null=True))
+    table = ds.dataset(path, format=csv_format).to_table(filter=arc_filter)
+    return table.to_pandas(types_mapper={pa.string(): arrow_str}.get)
+
+
+def keep_tweet(tweet):
+    # same predicates as arc_filter, on the tweet JSON
+    media = tweet.get('extended_entities', tweet.get('entities', {})).get('media', [])
+    return ('retweeted_status' not in tweet
+            and tweet.get('in_reply_to_status_id') is None
+            and any(item.get('type') == 'photo' for item in media))
+
+
+def read_tweets(path):
+    tweets = []
+    with open(path) as file:
+        for line in file:
+            # retweets are skipped before the line is even parsed
+            if '"retweeted_status"' in line:
+                continue
+            tweet = json.loads(line)
+            if keep_tweet(tweet):
+                tweets.append(tweet)
+    tweets = pd.DataFrame(tweets)
+    # every column holding only strings (text, source, lang, the *_str ids...) becomes an Arrow string column
+    text_columns = [column for column in tweets if pd.api.types.infer_dtype(tweets[column], skipna=True) == 'string']
+    tweets[text_columns] = tweets[text_columns].astype(arrow_str)
+    return tweets
+
+
+# ### Synthetic data for load testing
+# 
+# > The real files are small (2,356 tweets in the archive, 2,075 predictions). To test every step at a bigger volume and without network, the function below generates the three files (archive CSV, tweet JSON lines and predictions TSV) for any number of tweets. The same seed always gives the same files. 
+# > It uses the same columns as the real files and keeps their quirks: duplicated expanded_urls, wrong names ('a', 'the', ...), odd denominators, dogs with two stages, retweets, replies, tweets without photo, and tweets deleted from Twitter (in the archive but not in the JSON).
+
+# In[ ]:
+
+
+synthetic_dog_rates_user_id = 4196983835
+synthetic_sources = ['<a href="http://twitter.com/download/iphone" rel="nofollow">Twitter for iPhone</a>',
+                     '<a href="http://vine.co" rel="nofollow">Vine - Make a Scene</a>',
+                     '<a href="http://twitter.com" rel="nofollow">Twitter Web Client</a>',
+                     '<a href="https://about.twitter.com/products/tweetdeck" rel="nofollow">TweetDeck</a>']
+synthetic_good_names = ['Charlie', 'Lucy', 'Oliver', 'Cooper', 'Penny', 'Tucker', 'Lola', 'Winston', 'Bo', 'Sadie',
+                        'Toby', 'Daisy', 'Bailey', 'Buddy', 'Koda', 'Stanley', 'Jax', 'Milo', 'Bella', 'Rusty']
+synthetic_bad_names = ['a', 'the', 'an', 'very', 'just', 'quite', 'one', 'not', 'actually', 'mad']
+synthetic_dog_labels = ['golden_retriever', 'Labrador_retriever', 'Pembroke', 'Chihuahua', 'pug', 'chow', 'Samoyed',
+                        'toy_poodle', 'Pomeranian', 'malamute', 'cocker_spaniel', 'French_bulldog']
+synthetic_other_labels = ['seat_belt', 'teddy', 'web_site', 'tennis_ball', 'hamster', 'doormat']
+synthetic_stages = ['doggo', 'floofer', 'pupper', 'puppo']
+synthetic_codes = np.array(list('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'))
+
+
+synthetic_first = pd.Timestamp('2015-11-15 22:32:08')
+synthetic_last = pd.Timestamp('2017-08-01 16:23:56')
+
+
+def synthetic_timestamps(rows, n):
+    # row i of n: newest first like the archive, evenly spread from the first to the last tweet of the real archive,
+    # with a jitter smaller than the step (computed from the row number, so any chunk gives the same values)
+    step = (synthetic_last - synthetic_first).total_seconds() * 1000 / n
+    offsets = ((n - 1 - rows) * step).astype(np.int64) + (rows * 2654435761) % max(int(step), 1)
+    return synthetic_first + pd.to_timedelta(offsets, unit='ms')
+
+
+def synthetic_tweet_ids(rows, n):
+    # snowflake ids: milliseconds since the Twitter epoch in the high bits, a unique sequence in the low bits
+    epoch_ms = synthetic_timestamps(rows, n).asi8 // 10**6 - 1288834974657
+    return (epoch_ms << 22) + (n - 1 - rows) % (1 << 22)
+
+
+def generate_chunk(rng, rows, n, image_base_url):
+    # the archive rows, tweet JSON lines and predictions of the tweets number rows (out of n)
+    m = len(rows)
+    timestamps = synthetic_timestamps(rows, n)
+    tweet_ids = synthetic_tweet_ids(rows, n)
+
+    is_retweet = rng.random(m) < 0.077
+    is_reply = ~is_retweet & (rng.random(m) < 0.033)
+    # no url at all, a photo, or another link (videos, gofundme...)
+    url_kind = rng.choice(['none', 'photo', 'other'], m, p=[0.025, 0.895, 0.08])
+    url_kind[is_reply & (rng.random(m) < 0.7)] = 'none'
+    url_copies = np.where(rng.random(m) < 0.27, rng.integers(2, 5, m), 1)
+
+    numerators = rng.choice([12, 11, 10, 13, 9, 8, 7, 14, 5, 6, 3, 4, 1, 2, 420, 1776], m,
+                            p=np.array([558, 464, 461, 351, 158, 102, 55, 54, 37, 32, 19, 17, 9, 9, 2, 1]) / 2329)
+    denominators = np.where(rng.random(m) < 0.01, rng.choice([11, 50, 20, 80, 0, 15, 70, 7, 150, 2], m), 10)
+
+    name_kind = rng.choice(['good', 'bad', 'none'], m, p=[0.64, 0.05, 0.31])
+    names = np.where(name_kind == 'good', rng.choice(synthetic_good_names, m),
+                     np.where(name_kind == 'bad', rng.choice(synthetic_bad_names, m), 'None'))
+    # about 16% of the dogs have a stage, and a few of them two (doggo + pupper...)
+    stage_flags = rng.random((m, 4)) < np.array([0.04, 0.004, 0.11, 0.013])
+    stage_flags[:, 0] |= stage_flags[:, 1:].any(axis=1) & (rng.random(m) < 0.05)
+
+    # the retweeted/replied/quoted tweets are older tweets of the archive (or of another user)
+    older = np.minimum(rows + rng.integers(1, 50, m), n - 1)
+    older_ids = synthetic_tweet_ids(older, n)
+    older_times = synthetic_timestamps(older, n)
+    replied_users = np.where(rng.random(m) < 0.6, synthetic_dog_rates_user_id, rng.integers(10**8, 10**10, m))
+
+    t_codes = [''.join(code) for code in rng.choice(synthetic_codes, (m, 10))]
+    archive_rows, json_lines = [], []
+    for i in range(m):
+        tweet_id, ts = int(tweet_ids[i]), timestamps[i]
+        stage_words = [stage for stage, flag in zip(synthetic_stages, stage_flags[i]) if flag]
+        if name_kind[i] == 'good':
+            text = 'This is %s. ' % names[i]
+        elif name_kind[i] == 'bad':
+            text = 'This is %s %s. ' % (names[i], rng.choice(synthetic_dog_labels).replace('_', ' '))
+        else:
+            text = 'Here we have a very good %s. ' % (' '.join(stage_words) or 'dog')
+        text += ' '.join(['Would pet'] + stage_words + ['%d/%d' % (numerators[i], denominators[i]), 'https://t.co/' + t_codes[i]])
+
+        status_id = int(older_ids[i]) if is_retweet[i] else tweet_id
+        if url_kind[i] == 'photo':
+            expanded_urls = ','.join(['https://twitter.com/dog_rates/status/%d/photo/1' % status_id] * url_copies[i])
+        elif url_kind[i] == 'other':
+            expanded_urls = rng.choice(['https://twitter.com/dog_rates/status/%d/video/1' % status_id,
+                                        'https://www.gofundme.com/help-%s' % t_codes[i].lower()])
+        else:
+            expanded_urls = None
+        if is_retweet[i]:
+            text = 'RT @dog_rates: ' + text
+        if is_reply[i]:
+            text = '@dog_rates ' + text
+
+        archive_rows.append({
+            'tweet_id': tweet_id,
+            'in_reply_to_status_id': float(older_ids[i]) if is_reply[i] else None,
+            'in_reply_to_user_id': float(replied_users[i]) if is_reply[i] else None,
+            'timestamp': ts.strftime('%Y-%m-%d %H:%M:%S +0000'),
+            'source': synthetic_sources[rng.choice(4, p=[0.943, 0.039, 0.014, 0.004])],
+            'text': text,
+            'retweeted_status_id': float(older_ids[i]) if is_retweet[i] else None,
+            'retweeted_status_user_id': float(synthetic_dog_rates_user_id) if is_retweet[i] else None,
+            'retweeted_status_timestamp': older_times[i].strftime('%Y-%m-%d %H:%M:%S +0000') if is_retweet[i] else None,
+            'expanded_urls': expanded_urls,
+            'rating_numerator': numerators[i],
+            'rating_denominator': denominators[i],
+            'name': names[i],
+            **{stage: stage if flag else 'None' for stage, flag in zip(synthetic_stages, stage_flags[i])}})
+
+        # about 1% of the tweets were deleted and can't be queried any more
+        if rng.random() < 0.01:
+            continue
+        media = [{'type': 'photo', 'media_url_https': image_base_url + t_codes[i] + '.jpg'}] if url_kind[i] == 'photo' else []
+        retweets = int(rng.lognormal(6.5 + 1.5 * (n - rows[i]) / n, 1.0))
+        tweet = {
+            'created_at': ts.strftime('%a %b %d %H:%M:%S +0000 %Y'),
+            'id': tweet_id, 'id_str': str(tweet_id),
+            'full_text': text, 'truncated': False,
+            'entities': {'media': media} if media else {},
+            'source': archive_rows[-1]['source'],
+            'in_reply_to_status_id': int(older_ids[i]) if is_reply[i] else None,
+            'in_reply_to_status_id_str': str(older_ids[i]) if is_reply[i] else None,
+            'in_reply_to_user_id': int(replied_users[i]) if is_reply[i] else None,
+            'in_reply_to_user_id_str': str(replied_users[i]) if is_reply[i] else None,
+            'user': {'id': synthetic_dog_rates_user_id, 'screen_name': 'dog_rates'},
+            'is_quote_status': False,
+            'retweet_count': retweets,
+            'favorite_count': 0 if is_retweet[i] else int(retweets * rng.uniform(2, 5)),
+            'favorited': False, 'retweeted': False, 'lang': 'en'}
+        if media:
+            tweet['extended_entities'] = {'media': media}
+        if is_retweet[i]:
+            tweet['retweeted_status'] = {'id': int(older_ids[i]), 'full_text': text[len('RT @dog_rates: '):]}
+        elif rng.random() < 0.01:
+            tweet.update({'is_quote_status': True, 'quoted_status_id': int(older_ids[i]),
+                          'quoted_status_id_str': str(older_ids[i])})
+        json_lines.append(json.dumps(tweet) + '\n')
+
+    # predictions: ~88% of the original photo tweets, sorted by tweet_id like the real file,
+    # and a few tweets sharing the same image
+    photos = np.flatnonzero((url_kind == 'photo') & ~is_retweet & (rng.random(m) < 0.88))[::-1]
+    k = len(photos)
+    image_codes = np.array(t_codes, dtype=object)[photos]
+    shared = rng.random(k) < 0.03
+    image_codes[shared] = image_codes[rng.integers(0, max(k, 1), shared.sum())]
+    labels = np.array(synthetic_dog_labels + synthetic_other_labels)
+    is_dog_label = np.arange(len(labels)) < len(synthetic_dog_labels)
+    top3 = np.argsort(rng.random((k, len(labels))) + is_dog_label * 0.6, axis=1)[:, ::-1][:, :3]
+    confs = np.sort(rng.dirichlet([4, 1.5, 1, 3], k)[:, :3], axis=1)[:, ::-1]
+    predictions = pd.DataFrame({'tweet_id': tweet_ids[photos],
+                                'jpg_url': [image_base_url + code + '.jpg' for code in image_codes],
+                                'img_num': rng.choice([1, 2, 3, 4], k, p=[0.858, 0.095, 0.032, 0.015])})
+    for j in range(3):
+        predictions['p%d' % (j + 1)] = labels[top3[:, j]]
+        predictions['p%d_conf' % (j + 1)] = confs[:, j]
+        predictions['p%d_dog' % (j + 1)] = is_dog_label[top3[:, j]]
+
+    return pd.DataFrame(archive_rows), json_lines, predictions
+
+
+def write_synthetic_images(jpg_urls, image_dir):
+    # one small random JPEG per file name, always the same for a name (tweets sharing a jpg_url share the image)
+    from PIL import Image
+
+    os.makedirs(image_dir, exist_ok=True)
+    for name in set(url.rsplit('/', 1)[-1] for url in jpg_urls):
+        path = os.path.join(image_dir, name)
+        if not os.path.exists(path):
+            pixels = np.random.default_rng(list(name.encode())).integers(0, 256, (8, 8, 3), dtype=np.uint8)
+            Image.fromarray(pixels).resize((64, 64)).save(path)
+
+
+def generate_dataset(n_tweets, seed=0, out_dir='synthetic', image_base_url='https://pbs.twimg.com/media/',
+                     chunk_size=100000, image_dir=None):
+    # The tweets are generated chunk_size at a time and appended to the three files, so the memory used
+    # doesn't grow with n_tweets. The same seed and chunk_size always give the same files.
+    # image_dir: if given, the images of the predictions are written there too (needs Pillow),
+    # to be served by a local stand-in at image_base_url.
+    os.makedirs(out_dir, exist_ok=True)
+    archive_path = os.path.join(out_dir, 'twitter-archive-enhanced.csv')
+    json_path = os.path.join(out_dir, 'tweet-json.txt')
+    predictions_path = os.path.join(out_dir, 'image-predictions.tsv')
+
+    # the archive is newest first but the predictions oldest first:
+    # each chunk of predictions goes to its own part file, and the parts are joined in reverse order at the end
+    part_paths = []
+    with open(json_path, 'w') as json_file:
+        for chunk, start in enumerate(range(0, n_tweets, chunk_size)):
+            rng = np.random.default_rng([seed, chunk])
+            rows = np.arange(start, min(start + chunk_size, n_tweets))
+            archive, json_lines, predictions = generate_chunk(rng, rows, n_tweets, image_base_url)
+
+            archive.to_csv(archive_path, index=False, mode='w' if chunk == 0 else 'a', header=chunk == 0)
+            json_file.writelines(json_lines)
+            part_paths.append('%s.part%d' % (predictions_path, chunk))
+            predictions.to_csv(part_paths[-1], sep='\t', index=False, header=False)
+            if image_dir is not None:
+                write_synthetic_images(predictions.jpg_url, image_dir)
+
+    with open(predictions_path, 'w') as predictions_file:
+        predictions_file.write('\t'.join(['tweet_id', 'jpg_url', 'img_num'] + ['p%d%s' % (j, column) for j in (1, 2, 3)
+                                                                          for column in ('', '_conf', '_dog')]) + '\n')
+        for part_path in reversed(part_paths):
+            with open(part_path) as part_file:
+                shutil.copyfileobj(part_file, predictions_file)
+            os.remove(part_path)
+
+
+# In[ ]:
+
+
+# For load testing, set synthetic_scale to a number of tweets: the three files are generated in data_dir,
+# every output of the notebook is written there too, and the downloads / Twitter API queries below are skipped.
+# The synthetic jpg_urls point to synthetic_image_url: to run the image download (step 4) on them, serve the
+# generated images with `python -m http.server 8000 -d synthetic/images`.
+synthetic_scale = None
+synthetic_image_url = 'http://localhost:8000/'
+data_dir = '.'
+
+# Optional steps: downloading the tweet images (step 4) needs aiohttp, Pillow and network access,
+# unless image_base_url points to a local stand-in serving the same file names.
+download_tweet_images = False
+image_base_url = None
+# re-scoring the cached images (step 5) needs torch and torchvision, and downloads the model weights once
+rescore_tweet_images = False
+
+if synthetic_scale is not None:
+    data_dir = 'synthetic'
+    generate_dataset(synthetic_scale, seed=42, out_dir=data_dir, image_base_url=synthetic_image_url,
+                     image_dir=os.path.join(data_dir, 'images') if download_tweet_images else None)
+
+
 # ## Data Gathering
 # In the cell below, I will gather **all** three pieces of data for this project and load them in this notebook. 
 # **Note:** the methods required to gather each data are different.
 # 1. Directly downloading the WeRateDogs Twitter archive data (twitter_archive_enhanced.csv)
 
-# In[2]:
+# In[ ]:
 
 
 #First, I downloaded the Twitter archive from Udacity and will read it into a dataframe.
-twit_arc_raw = pd.read_csv('twitter-archive-enhanced.csv')
+twit_arc_raw = read_archive(os.path.join(data_dir, 'twitter-archive-enhanced.csv'))
 
 
 # 2. Using the Requests library to download the tweet image prediction (image_predictions.tsv)
 
 # > 'image_predictions.tsv' is hosted on Udacity's server and will be downloaded programmatically using the Requests library. I will use this URL :'https://d17h27t6h515a5.cloudfront.net/topher/2017/August/599fd2ad_image-predictions/image-predictions.tsv'
 
-# In[3]:
+# In[ ]:
 
 
 # Image predictions URL provided by Udacity
 url = 'https://d17h27t6h515a5.cloudfront.net/topher/2017/August/599fd2ad_image-predictions/image-predictions.tsv'
-response = requests.get(url)
+if synthetic_scale is None:
+    response = requests.get(url)
 
-with open (url.split('/')[-1], mode='wb') as file:
-    file.write(response.content)
+    with open (url.split('/')[-1], mode='wb') as file:
+        file.write(response.content)
 
 
-# In[4]:
+# In[ ]:
 
 
-predict_raw = pd.read_csv('image-predictions.tsv', sep='\t')
+predict_raw = pd.read_csv(os.path.join(data_dir, 'image-predictions.tsv'), sep='\t', dtype=dict.fromkeys(predict_text_columns, arrow_str))
 
 
 # 3. Using the Tweepy library to **query** additional data via the Twitter API (tweet_json.txt)
 
 # > The Twitter archive provided by Udacity does not have all of the desired data, specifically retweet and favorite counts. I will use the Twitter API to read each tweet's JSON data into its own line in a TXT file. Then I will read this file line by line to create a dataframe with retweet and favorite counts. Some of the tweets provided by Udacity may have been deleted, so I will also keep track of this. Note that the consumer_key, consumer_secret, access_token, and access_secret have been deleted here.
 
-# In[5]:
+# In[ ]:
 
 
 ## Install Tweepy if haven't already:
 #!pip install tweepy
 
 
-# In[5]:
+# In[ ]:
 
 
 # Setting up Twitter API credentials:
@@ -79,37 +388,335 @@ api = tweepy.API(auth, wait_on_rate_limit=True)
 tweet_ids = twit_arc_raw.tweet_id.values
 len(tweet_ids)
 
-# Query Twitter's API for JSON data for each tweet ID in the Twitter archive
-count = 0
-fails_dict = {}
-start = timer()
-# Save each tweet's returned JSON as a new line in a .txt file
-with open('tweet_json.txt', 'w') as outfile:
-    # This loop will likely take 20-30 minutes to run because of Twitter's rate limit
-    for tweet_id in tweet_ids:
-        count += 1
-        print(str(count) + ": " + str(tweet_id))
+# Query Twitter's API for JSON data for each tweet ID in the Twitter archive (not needed for the synthetic data)
+if synthetic_scale is None:
+    count = 0
+    fails_dict = {}
+    start = timer()
+    # Save each tweet's returned JSON as a new line in a .txt file
+    with open('tweet_json.txt', 'w') as outfile:
+        # This loop will likely take 20-30 minutes to run because of Twitter's rate limit
+        for tweet_id in tweet_ids:
+            count += 1
+            print(str(count) + ": " + str(tweet_id))
+            try:
+                tweet = api.get_status(tweet_id, tweet_mode='extended')
+                print("Success")
+                json.dump(tweet._json, outfile)
+                outfile.write('\n')
+            except tweepy.TweepError as e:
+                print("Fail")
+                fails_dict[tweet_id] = e
+                pass
+    end = timer()
+    print(end - start)
+    print(fails_dict)
+
+
+# In[ ]:
+
+
+twit_json_raw = read_tweets(os.path.join(data_dir, 'tweet-json.txt'))
+
+
+# 4. Downloading the tweet images (jpg_url in image_predictions.tsv)
+
+# > The image predictions only give the *jpg_url* of each photo. To re-run a classifier and to find duplicated photos, I will download the images with **asyncio** and **aiohttp**: one connection pool, a limit of connections per host and retries for the failed requests. 
+# > Each image is stored in a content-addressed cache (the file name is the sha256 of its bytes), so the same photo is only stored once, and a perceptual hash (dHash) is computed for it. The cache keeps an index.csv with tweet_id, jpg_url, sha256 and phash, saved after each batch of downloads, so only the new URLs are downloaded next time (even after an interrupted run).
+# > This step only runs when *download_tweet_images* is True. To test it without Twitter, set *image_base_url* to a local server (e.g. `python -m http.server 8000` in a folder with the images, and `image_base_url = 'http://localhost:8000/'`): the file name of each *jpg_url* is then fetched from there.
+
+# In[ ]:
+
+
+## Install aiohttp and Pillow if haven't already:
+#!pip install aiohttp pillow
+
+
+# In[ ]:
+
+
+import asyncio
+import hashlib
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+image_cache_dir = os.path.join(data_dir, 'image_cache')
+image_index_path = os.path.join(image_cache_dir, 'index.csv')
+
+
+def cache_path(digest):
+    # content-addressed: image_cache/<first 2 characters of the sha256>/<sha256>.jpg
+    return os.path.join(image_cache_dir, digest[:2], digest + '.jpg')
+
+
+def write_atomic(path, write):
+    # written to a temporary file in the same directory, then renamed: a run killed while writing
+    # never leaves a truncated file under the final name
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(descriptor, mode='wb') as file:
+            write(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def perceptual_hash(content):
+    from PIL import Image
+
+    # dHash: 9x8 greyscale thumbnail, one bit per pixel brighter than its left neighbour -> 64 bits
+    image = Image.open(BytesIO(content)).convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = np.asarray(image, dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return bits.tobytes().hex()
+
+
+async def fetch_image(session, url, retries):
+    import aiohttp
+
+    for attempt in range(retries):
         try:
-            tweet = api.get_status(tweet_id, tweet_mode='extended')
-            print("Success")
-            json.dump(tweet._json, outfile)
-            outfile.write('\n')
-        except tweepy.TweepError as e:
-            print("Fail")
-            fails_dict[tweet_id] = e
-            pass
-end = timer()
-print(end - start)
-print(fails_dict)
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # client errors (404 for deleted tweets...) won't get better with a retry
+            client_error = isinstance(e, aiohttp.ClientResponseError) and e.status < 500
+            if client_error or attempt == retries - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+
+async def cache_image(session, tweet_id, url, source_url, retries):
+    content = await fetch_image(session, source_url, retries)
+    digest = hashlib.sha256(content).hexdigest()
+    path = cache_path(digest)
+    if not os.path.exists(path):
+        write_atomic(path, lambda file: file.write(content))
+    # decoding the image is CPU work, so it runs in a thread and doesn't block the other downloads
+    phash = await asyncio.get_running_loop().run_in_executor(None, perceptual_hash, content)
+    return {'tweet_id': tweet_id, 'jpg_url': url, 'sha256': digest, 'phash': phash}
+
+
+async def download_images(images, base_url=None, max_connections=20, per_host=8, retries=3, timeout=30):
+    # images: dataframe with tweet_id and jpg_url columns
+    # base_url: if given, the file name of each jpg_url is fetched from there instead (local stand-in)
+    import aiohttp
+
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=per_host)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        results = await asyncio.gather(*[cache_image(session, tweet_id, url,
+                                                     url if base_url is None else base_url + url.rsplit('/', 1)[-1],
+                                                     retries)
+                                         for tweet_id, url in zip(images.tweet_id, images.jpg_url)],
+                                       return_exceptions=True)
+    downloaded = [result for result in results if isinstance(result, dict)]
+    fails = {tweet_id: result for tweet_id, result in zip(images.tweet_id, results)
+             if isinstance(result, Exception)}
+    return pd.DataFrame(downloaded, columns=['tweet_id', 'jpg_url', 'sha256', 'phash']), fails
+
+
+def run_coroutine(coroutine):
+    # asyncio.run() can't be called inside Jupyter, where an event loop is already running:
+    # the coroutine then runs on its own event loop in another thread
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
+
+# In[ ]:
+
+
+# Only the URLs which are not in the cache yet are downloaded
+if os.path.exists(image_index_path):
+    image_index = pd.read_csv(image_index_path, dtype=dict.fromkeys(['jpg_url', 'sha256', 'phash'], arrow_str))
+else:
+    image_index = pd.DataFrame(columns=['tweet_id', 'jpg_url', 'sha256', 'phash'])
+
+if download_tweet_images:
+    new_images = predict_raw.loc[~predict_raw.jpg_url.isin(image_index.jpg_url), ['tweet_id', 'jpg_url']]
+
+    # The URLs are downloaded by batches and the index is saved after each one,
+    # so a run that stops halfway only loses the batch in progress.
+    batch_size = 1000
+    image_fails = {}
+    start = timer()
+    for batch_start in range(0, len(new_images), batch_size):
+        downloaded, fails = run_coroutine(download_images(new_images[batch_start:batch_start + batch_size],
+                                                          base_url=image_base_url))
+        image_fails.update(fails)
+        image_index = pd.concat([image_index, downloaded], ignore_index=True)
+        write_atomic(image_index_path, lambda file: image_index.to_csv(file, index=False))
+    end = timer()
+    print(end - start)
+    print(image_fails)
+
+
+# In[ ]:
+
+
+def find_duplicate_images(image_index, max_distance=4):
+    # Two hashes at most max_distance bits apart share at least one of max_distance + 1 bands (pigeonhole),
+    # so only the images with a common band are compared instead of all the pairs.
+    hashes = np.array([int(phash, 16) for phash in image_index.phash], dtype=np.uint64)
+    bounds = np.linspace(0, 64, max_distance + 2).astype(int)
+    candidates = []
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        band = pd.DataFrame({'pos': np.arange(len(hashes)),
+                             'key': (hashes >> np.uint64(low)) & np.uint64((1 << int(high - low)) - 1)})
+        pairs = band.merge(band, on='key')
+        candidates.append(pairs.loc[pairs.pos_x < pairs.pos_y, ['pos_x', 'pos_y']])
+    candidates = pd.concat(candidates).drop_duplicates()
+
+    left, right = candidates.pos_x.values, candidates.pos_y.values
+    distance = np.unpackbits((hashes[left] ^ hashes[right]).view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+    keep = distance <= max_distance
+    return pd.DataFrame({'tweet_id_a': image_index.tweet_id.values[left[keep]],
+                         'tweet_id_b': image_index.tweet_id.values[right[keep]],
+                         'distance': distance[keep]}).sort_values('distance', ignore_index=True)
+
+
+duplicate_images = find_duplicate_images(image_index)
+duplicate_images.head()
+
+
+# 5. Re-scoring the breed predictions from the cached images
+
+# > The p1, p2, p3 predictions in image_predictions.tsv come from a model I can't run again. With the images in the cache, I can score them with my own classifier on CPU and write a new table with the **same columns** (tweet_id, jpg_url, img_num, p1, p1_conf, p1_dog ... p3_dog). 
+# > The classifier is pluggable: any function which takes a list of PIL images and returns, for each image, its top 3 predictions as (breed, confidence, is_dog). The images are scored in batches on a thread pool, and a manifest keeps the tweet_id, jpg_url and sha256 of every scored image, so only the new or changed images are scored again, and the tweets which are no longer in the predictions are dropped from the table. The classifier is only built when there is something to score. 
+# > This step only runs when *rescore_tweet_images* is True (it needs torch, and downloads the model weights the first time).
+
+# In[ ]:
+
+
+## Install torch and torchvision (CPU) if haven't already:
+#!pip install torch torchvision --index-url https://download.pytorch.org/whl/cpu
+
+
+# In[ ]:
+
+
+from functools import partial
+
+rescored_path = os.path.join(data_dir, 'image-predictions-rescored.tsv')
+rescored_manifest_path = os.path.join(data_dir, 'image-predictions-rescored-manifest.csv')
+prediction_columns = ['tweet_id', 'jpg_url', 'img_num',
+                      'p1', 'p1_conf', 'p1_dog', 'p2', 'p2_conf', 'p2_dog', 'p3', 'p3_conf', 'p3_dog']
+
+
+def make_torchvision_classifier():
+    # ImageNet classifier, like the one used for image_predictions.tsv. The dog breeds are the classes 151 to 268.
+    import torch
+    from torchvision.models import resnet50, ResNet50_Weights
 
+    weights = ResNet50_Weights.DEFAULT
+    model = resnet50(weights=weights).eval()
+    preprocess = weights.transforms()
+    labels = [label.replace(' ', '_') for label in weights.meta['categories']]
 
-# In[6]:
+    def classify(images):
+        batch = torch.stack([preprocess(image) for image in images])
+        with torch.inference_mode():
+            confs, classes = model(batch).softmax(dim=1).topk(3, dim=1)
+        return [[(labels[i], conf, 151 <= i <= 268) for conf, i in zip(row_confs, row_classes)]
+                for row_confs, row_classes in zip(confs.tolist(), classes.tolist())]
 
+    return classify
 
-twit_json_raw = pd.read_json('tweet-json.txt', lines=True)
 
+def make_synthetic_classifier():
+    # stub for the synthetic data: the breeds are picked from the mean colour of the image, always the same for an image
+    labels = synthetic_dog_labels + synthetic_other_labels
 
-# In[7]:
+    def classify(images):
+        predictions = []
+        for image in images:
+            r, g, b = (int(value) for value in np.asarray(image).reshape(-1, 3).mean(axis=0))
+            picks = [labels[value % len(labels)] for value in (r, g, b)]
+            predictions.append([(label, conf, label in synthetic_dog_labels) for label, conf in zip(picks, (0.6, 0.25, 0.1))])
+        return predictions
+
+    return classify
+
+
+def score_batch(batch, classifier):
+    from PIL import Image
+
+    images = [Image.open(cache_path(digest)).convert('RGB') for digest in batch.sha256]
+    rows = []
+    for (tweet_id, jpg_url, img_num), top3 in zip(zip(batch.tweet_id, batch.jpg_url, batch.img_num), classifier(images)):
+        row = {'tweet_id': tweet_id, 'jpg_url': jpg_url, 'img_num': img_num}
+        for n, (breed, conf, is_dog) in enumerate(top3, start=1):
+            row.update({'p%d' % n: breed, 'p%d_conf' % n: conf, 'p%d_dog' % n: bool(is_dog)})
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def rescore_predictions(image_index, predictions, make_classifier, batch_size=32, max_workers=4):
+    # predictions: the current tweet_id, jpg_url and img_num of the tweets (image_predictions.tsv)
+    # make_classifier: function building the classifier, only called if some image has to be scored
+    manifest_columns = ['tweet_id', 'jpg_url', 'sha256']
+    if os.path.exists(rescored_path):
+        rescored = pd.read_csv(rescored_path, sep='\t', dtype=dict.fromkeys(predict_text_columns, arrow_str))
+    else:
+        rescored = pd.DataFrame(columns=prediction_columns)
+    if os.path.exists(rescored_manifest_path):
+        manifest = pd.read_csv(rescored_manifest_path, dtype={'jpg_url': arrow_str, 'sha256': arrow_str})
+    else:
+        # without a manifest, every image is scored again
+        manifest = pd.DataFrame(columns=manifest_columns).astype({'tweet_id': int, 'jpg_url': arrow_str, 'sha256': arrow_str})
+    # a manifest entry only counts if its row is still in the table
+    manifest = manifest[manifest.tweet_id.isin(rescored.tweet_id)]
+
+    # the cached image of the current jpg_url of each tweet
+    current = predictions[['tweet_id', 'jpg_url', 'img_num']].merge(
+        image_index[['jpg_url', 'sha256']].drop_duplicates('jpg_url'), on='jpg_url')
+    # only the images which were never scored for this tweet and URL, or whose content changed since
+    scored = current.merge(manifest, on=manifest_columns, how='left', indicator=True)
+    todo = scored[scored._merge == 'left_only'].drop(columns='_merge')
+
+    if len(todo) > 0:
+        classifier = make_classifier()
+        batches = [todo.iloc[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            new_predictions = pd.concat(pool.map(partial(score_batch, classifier=classifier), batches), ignore_index=True)
+
+        # replacing the rows of the re-scored tweets (the empty frames of the first run are left out of the concat)
+        frames = [rescored[~rescored.tweet_id.isin(todo.tweet_id)], new_predictions[prediction_columns]]
+        rescored = pd.concat([frame for frame in frames if len(frame)], ignore_index=True)
+        frames = [manifest[~manifest.tweet_id.isin(todo.tweet_id)], todo[manifest_columns]]
+        manifest = pd.concat([frame for frame in frames if len(frame)], ignore_index=True)
+
+    # the table keeps the same tweets as the current predictions: the tweets which left them are dropped
+    stale = ~rescored.tweet_id.isin(current.tweet_id)
+    if len(todo) > 0 or stale.any():
+        rescored = rescored[~stale].reset_index(drop=True)
+        manifest = manifest[manifest.tweet_id.isin(current.tweet_id)].reset_index(drop=True)
+        write_atomic(rescored_path, lambda file: rescored.to_csv(file, sep='\t', index=False))
+        write_atomic(rescored_manifest_path, lambda file: manifest.to_csv(file, index=False))
+
+    return rescored, len(todo)
+
+
+# In[ ]:
+
+
+if rescore_tweet_images:
+    start = timer()
+    # the synthetic images are random pixels: a stub classifier is enough, and needs neither torch nor network
+    make_classifier = make_torchvision_classifier if synthetic_scale is None else make_synthetic_classifier
+    predict_rescored, n_scored = rescore_predictions(image_index, predict_raw, make_classifier)
+    end = timer()
+    print(n_scored, 'images scored in', end - start, 'seconds')
+
+
+# In[ ]:
 
 
 # Copies for cleaning
@@ -134,7 +741,7 @@ twit_json = twit_json_raw.copy()
 # 
 # 
 
-# In[8]:
+# In[ ]:
 
 
 # Now that the data is gathered, I will assess it. 
@@ -143,57 +750,90 @@ twit_json = twit_json_raw.copy()
 twit_arc 
 
 
-# In[12]:
+# In[ ]:
 
 
 twit_arc.info()
 
 
-# In[13]:
+# In[ ]:
 
 
 predict 
 
 
-# In[14]:
+# In[ ]:
 
 
 predict.info()
 
 
-# In[15]:
+# In[ ]:
 
 
 twit_json
 
 
-# In[16]:
+# In[ ]:
 
 
 twit_json.info()
 
 
-# In[9]:
+# ### Programmatic assessment: quality rules
+# 
+# Instead of running the checks one by one (duplicated(), query(), info() ...) and only printing them, I will write the checks down as **rules**. 
+# Each rule is a vectorized function that returns a boolean mask with *True* on the rows that break it. All the rules of one dataframe are evaluated together, and the result is a violations report with the rule name, the row index and the tweet id of every bad row.
 
+# In[ ]:
 
-# checking for duplicates 
 
-twit_arc.duplicated().sum()
+# Rules for each dataframe: rule name -> function returning a boolean mask of the violating rows
+arc_rules = {
+    'unique_tweet_id': lambda df: df.tweet_id.duplicated(keep=False),
+    'denominator_is_10': lambda df: df.rating_denominator != 10,
+    'valid_name': lambda df: df.name.fillna('None').str.islower(),
+    'url_not_null': lambda df: df.expanded_urls.isnull(),
+    'retweet_absent': lambda df: df.retweeted_status_id.notnull(),
+}
 
+predict_rules = {
+    'unique_tweet_id': lambda df: df.tweet_id.duplicated(keep=False),
+    'url_not_null': lambda df: df.jpg_url.isnull(),
+}
 
-# In[10]:
+json_rules = {
+    'unique_tweet_id': lambda df: df.id.duplicated(keep=False),
+    'retweet_absent': lambda df: df['retweeted_status'].notnull() if 'retweeted_status' in df else pd.Series(False, index=df.index),
+}
 
 
-predict.duplicated().sum()
+def assess_quality(dataset, rules, frame_name, id_column='tweet_id'):
+    # evaluating every rule on the whole column at once, giving one (rows x rules) boolean matrix
+    masks = np.column_stack([np.asarray(check(dataset), dtype=bool) for check in rules.values()])
+    rows, cols = np.nonzero(masks)
+    report = pd.DataFrame({'frame': frame_name,
+                           'rule': np.array(list(rules))[cols],
+                           'row': dataset.index.values[rows],
+                           'tweet_id': dataset[id_column].values[rows]})
+    return report.sort_values(['rule', 'row'], ignore_index=True)
 
 
-# In[11]:
+# In[ ]:
 
 
-twit_json.id.duplicated().sum()
+# checking all the rules in one pass per dataframe
+quality_report = pd.concat([assess_quality(twit_arc, arc_rules, 'twit_arc'),
+                            assess_quality(predict, predict_rules, 'predict'),
+                            assess_quality(twit_json, json_rules, 'twit_json', id_column='id')],
+                           ignore_index=True)
 
+# machine-readable report, one record per violation
+quality_report.to_json(os.path.join(data_dir, 'quality_report.json'), orient='records', lines=True)
+quality_report.groupby(['frame', 'rule']).size()
 
-# In[12]:
+
+# In[ ]:
 
 
 # checking for datatype 01 & missing values
@@ -201,7 +841,7 @@ twit_json.id.duplicated().sum()
 twit_arc.info()
 
 
-# In[44]:
+# In[ ]:
 
 
 # checking for wrong names
@@ -210,15 +850,16 @@ pd.set_option('display.max_rows', 30)
 twit_arc.name.value_counts()
 
 
-# In[13]:
+# In[ ]:
 
 
-twit_arc.query("name in ['a', 'an', 'the', 'not', 'actually']").name.value_counts()
+bad_names = quality_report.query("frame == 'twit_arc' and rule == 'valid_name'").row
+twit_arc.loc[bad_names].name.value_counts()
 # there were many names which were clearly wring names ( a, the, an, not ....) 
 # I will change those names into "None" 
 
 
-# In[14]:
+# In[ ]:
 
 
 # First, converting the rating_numerator and rating_denominator columns to integers using the astype() method:
@@ -226,20 +867,20 @@ twit_arc_check = twit_arc['rating_numerator'].astype(int)
 twit_arc_check = twit_arc['rating_denominator'].astype(int)
 
 
-# In[15]:
+# In[ ]:
 
 
 # checking for the wrong ratings
 
-twit_arc_check = twit_arc.query('rating_denominator != 10')
-twit_arc_check = twit_arc_check[['text','rating_numerator', 'rating_denominator']]
+bad_ratings = quality_report.query("frame == 'twit_arc' and rule == 'denominator_is_10'").row
+twit_arc_check = twit_arc.loc[bad_ratings, ['text','rating_numerator', 'rating_denominator']]
 twit_arc_check.head()
 
 # Some rows have wrong rating denominator & rating numerator.
 # They must be amended manually, based on what's written on "text" column.
 
 
-# In[16]:
+# In[ ]:
 
 
 # checking for datatypes 02
@@ -247,7 +888,7 @@ twit_arc_check.head()
 predict.info()
 
 
-# In[35]:
+# In[ ]:
 
 
 # checking for datatypes 03
@@ -298,7 +939,7 @@ twit_json.info()
 
 # #### Code
 
-# In[8]:
+# In[ ]:
 
 
 # 1. Removing null values in expanded_urls with .dropna functions
@@ -306,20 +947,16 @@ twit_json.info()
 twit_arc.dropna(subset = ['expanded_urls'], inplace = True)
 
 # 2. Splitting the value with .split function, and choose the first value
-def delete_duplicated_urls(url):
-    true_url = url.split(',')[0]
-    return true_url
-
-twit_arc['correct_expanded_urls'] = twit_arc.apply(lambda x: delete_duplicated_urls(x['expanded_urls']), axis=1)
+twit_arc['correct_expanded_urls'] = twit_arc.expanded_urls.str.replace(r',.*', '', regex=True)
 twit_arc.drop('expanded_urls', axis=1, inplace=True)
 
-#The apply() function is then used to apply the delete_duplicated_urls() function to each row in the twit_arc DataFrame, using the axis=1 parameter to apply the function row-wise. The resulting URLs are stored in a new column called correct_expanded_urls.
+#The .str accessor cuts everything after the first comma in the whole column at once, so the URLs stay in an Arrow string column instead of going through a row-wise apply() with Python strings. The resulting URLs are stored in a new column called correct_expanded_urls.
 #the original expanded_urls column is dropped from the twit_arc DataFrame using the drop() function, with axis=1 specifying that we want to drop a column rather than a row
 
 
 # #### Test
 
-# In[9]:
+# In[ ]:
 
 
 for index,row in twit_arc.iterrows():
@@ -333,21 +970,20 @@ for index,row in twit_arc.iterrows():
 # Reason: because the "source" column contains HTML code that needs to be cleaned up before it can be analyzed properly.
 # I will remove non-null rows, which are not required for our analysis. Since the three columns shares the same non-empty rows, we can just base on one of the columns.
 # 
+# The retweets are now removed while reading the archive (see *arc_filter* in Data Gathering), together with the replies and the tweets without photo, so there is nothing left to drop here.
 # 
 
 # #### Code
 
-# In[10]:
-
+# In[ ]:
 
-retweeted_status_id_index = twit_arc[twit_arc.retweeted_status_id.notnull()].index
 
-twit_arc.drop(retweeted_status_id_index, axis = 0, inplace= True)
+twit_arc.retweeted_status_id.notnull().sum() # filtered at load time
 
 
 # #### Test
 
-# In[11]:
+# In[ ]:
 
 
 twit_arc[twit_arc.retweeted_status_user_id.notnull()] #worked!
@@ -361,15 +997,16 @@ twit_arc[twit_arc.retweeted_status_user_id.notnull()] #worked!
 
 # #### Code
 
-# In[12]:
+# In[ ]:
 
 
-twit_arc.timestamp = twit_arc.timestamp.astype('datetime64')
+# timestamps are in UTC ("+0000"), so they are parsed and kept as naive UTC datetimes
+twit_arc.timestamp = pd.to_datetime(twit_arc.timestamp).dt.tz_localize(None)
 
 
 # #### Test
 
-# In[13]:
+# In[ ]:
 
 
 twit_arc.info() #worked!
@@ -383,44 +1020,45 @@ twit_arc.info() #worked!
 
 # #### Code
 
-# In[14]:
+# In[ ]:
 
 
-# We found out in the previous assessment that index 1068, 1165, 1662, 2335, 516 must be amended.
+# We found out in the previous assessment that these tweets (index 1068, 1165, 1662, 2335, 516 of the original archive) must be amended.
+# The archive is filtered while loading, so the rows are found by tweet_id instead of index.
 
-numbers = [1068, 1165, 1662, 2335, 516]
+numbers = [740373189193256964, 722974582966214656, 682962037429899265, 666287406224695296, 810984652412424192]
 
-for n in numbers:
-    print(twit_arc.query('rating_denominator != 10').loc[n, 'rating_numerator'],'/',twit_arc.query('rating_denominator != 10').loc[n, 'rating_denominator'])
+print(twit_arc.loc[twit_arc.tweet_id.isin(numbers), ['tweet_id', 'rating_numerator', 'rating_denominator']])
 
 
-# In[15]:
+# In[ ]:
 
 
 # amending 5 rows
 
-twit_arc['rating_numerator'].replace([9,4, 7, 1,24], [14,13,10, 9, 10], inplace = True)
-twit_arc['rating_denominator'].replace([11,20, 11, 2,7], [10,10,10, 10, 10], inplace = True)
+# the right rating of each tweet in numbers, read from its text
+right_ratings = [(14, 10), (13, 10), (10, 10), (9, 10), (10, 10)]
 
-# The last column (index 516) doesn't have any ratings in the note, but I will change it to 10/10 for convenience in calculation
+# only these 5 tweets are changed (a replace() on the whole column would also change every other 9, 7, 4 and 1 rating)
+for n, rating in zip(numbers, right_ratings):
+    twit_arc.loc[twit_arc.tweet_id == n, ['rating_numerator', 'rating_denominator']] = rating
 
+# The last tweet (index 516) doesn't have any ratings in the note, but I will change it to 10/10 for convenience in calculation
 
-# In[16]:
+
+# In[ ]:
 
 
 # combining into a single column
-twit_arc['ratings'] = twit_arc['rating_numerator'].astype('str') + "/" +twit_arc['rating_denominator'].astype('str')
+twit_arc['ratings'] = twit_arc['rating_numerator'].astype(arrow_str) + "/" +twit_arc['rating_denominator'].astype(arrow_str)
 
 
 # #### Test
 
-# In[17]:
-
+# In[ ]:
 
-numbers = [1068, 1165, 1662, 2335, 516]
 
-for n in numbers:
-    print(twit_arc.loc[n, 'ratings'])
+print(twit_arc.loc[twit_arc.tweet_id.isin(numbers), ['tweet_id', 'ratings']])
     
 # I will not drop the original ratings columns for now, since they might come in handy in future.
 
@@ -430,16 +1068,18 @@ for n in numbers:
 # #### Define
 # 
 # I will change the datatype of *tweet_id*, *in_reply_to_status_id*, *in_reply_to_user_id* to str
+# 
+# The (empty) *retweeted_status_id* and *retweeted_status_user_id* columns are converted too, so they stay Arrow strings when the missing values are replaced by "None" in Issue #6.
 
 # #### Code
 
-# In[18]:
+# In[ ]:
 
 
-ids_list = ['tweet_id', "in_reply_to_status_id", "in_reply_to_user_id"]
+ids_list = ['tweet_id', "in_reply_to_status_id", "in_reply_to_user_id", "retweeted_status_id", "retweeted_status_user_id"]
 
 def string_convert(dataset, column):
-    dataset[column] = dataset[column].astype('str')
+    dataset[column] = dataset[column].astype(arrow_str)
     result = dataset[column]
     return result
 
@@ -449,7 +1089,7 @@ for ids in ids_list:
 
 # #### Test
 
-# In[19]:
+# In[ ]:
 
 
 twit_arc.info()
@@ -463,18 +1103,18 @@ twit_arc.info()
 
 # #### Code
 
-# In[20]:
+# In[ ]:
 
 
 mask = twit_arc.name.fillna("lower").str.islower()
 column_name = 'name'
-twit_arc.loc[mask, column_name] = np.nan
+twit_arc[column_name] = twit_arc[column_name].mask(mask)
 twit_arc.replace(np.nan, "None", inplace = True)
 
 
 # #### Test
 
-# In[21]:
+# In[ ]:
 
 
 twit_arc.query('name == "a"') #worked!
@@ -488,20 +1128,21 @@ twit_arc.query('name == "a"') #worked!
 
 # #### Code
 
-# In[22]:
+# In[ ]:
 
 
 ids_list = ['id', "in_reply_to_status_id", "in_reply_to_user_id", "quoted_status_id"]
 
-for ids in ids_list:
+# (a column is missing when none of the loaded tweets has it, e.g. no quoted tweet is left after the filtering)
+for ids in twit_json.columns.intersection(ids_list):
     string_convert(twit_json, ids) #converts from strings to integers
     
-twit_json.drop(["in_reply_to_status_id_str", "in_reply_to_user_id_str", "quoted_status_id_str"], axis = 1, inplace = True)
+twit_json.drop(["in_reply_to_status_id_str", "in_reply_to_user_id_str", "quoted_status_id_str"], axis = 1, inplace = True, errors = 'ignore')
 
 
 # #### Test
 
-# In[23]:
+# In[ ]:
 
 
 twit_json.info()
@@ -515,7 +1156,7 @@ twit_json.info()
 
 # #### Code
 
-# In[24]:
+# In[ ]:
 
 
 columns_list = ['p1', 'p2', 'p3']
@@ -526,7 +1167,7 @@ for columns in columns_list:
 
 # #### Test
 
-# In[25]:
+# In[ ]:
 
 
 predict.sample(5) #First letter is indeed capitalized
@@ -536,7 +1177,7 @@ predict.sample(5) #First letter is indeed capitalized
 
 # #### Code
 
-# In[26]:
+# In[ ]:
 
 
 # changing the datatype of tweet_id to str
@@ -545,7 +1186,7 @@ string_convert(predict, 'tweet_id');
 
 # #### Test
 
-# In[27]:
+# In[ ]:
 
 
 print(predict['tweet_id'].dtype) #correct
@@ -557,7 +1198,7 @@ print(predict['tweet_id'].dtype) #correct
 
 # #### Code
 
-# In[28]:
+# In[ ]:
 
 
 twit_arc.doggo.replace('None', '', inplace=True)
@@ -570,7 +1211,7 @@ twit_arc.puppo.replace('None', '', inplace=True)
 twit_arc.puppo.replace(np.NaN, '', inplace=True)
 
 
-# In[29]:
+# In[ ]:
 
 
 twit_arc['dog_stage'] = twit_arc.doggo + twit_arc.floofer + twit_arc.pupper + twit_arc.puppo
@@ -584,7 +1225,7 @@ twit_arc.drop(['doggo', 'floofer', 'pupper', 'puppo'], axis=1, inplace=True)
 
 # #### Test
 
-# In[30]:
+# In[ ]:
 
 
 twit_arc.dog_stage.value_counts()
@@ -597,7 +1238,7 @@ twit_arc.dog_stage.value_counts()
 
 # #### Code
 
-# In[31]:
+# In[ ]:
 
 
 # Rename the 'id' column to 'tweet_id' in the twit_json dataset
@@ -608,7 +1249,7 @@ twit_arc = pd.merge(twit_arc, id_retweet, on = ['tweet_id'])
 
 # #### Test
 
-# In[46]:
+# In[ ]:
 
 
 twit_arc.info()
@@ -620,7 +1261,7 @@ twit_arc.info()
 
 # #### Code
 
-# In[32]:
+# In[ ]:
 
 
 # Function to extract the correct breed prediction
@@ -637,7 +1278,7 @@ for i in range(len(predict)):
         dog_predict.append("No correct prediction")
 
         # Applying the function to the predict dataset
-predict['dog_predict'] = dog_predict
+predict['dog_predict'] = pd.array(dog_predict, dtype=arrow_str)
 predict_copy = predict[['tweet_id', 'dog_predict']]
 
 # Merge the breed_prediction column into the twit_arc dataset
@@ -646,13 +1287,13 @@ twit_arc = pd.merge(twit_arc, predict_copy, on = ['tweet_id'], how= 'left')
 
 # #### Test
 
-# In[33]:
+# In[ ]:
 
 
 print("Columns in twit_arc dataset:", twit_arc.columns) #breed_prediction column has been added
 
 
-# In[34]:
+# In[ ]:
 
 
 twit_arc.sample(2)
@@ -661,14 +1302,25 @@ twit_arc.sample(2)
 # ## Storing Data
 # Saving gathered, assessed, and cleaned master dataset to a CSV file named "twitter_archive_master.csv".
 
-# In[35]:
+# In[ ]:
 
 
 # Save the master dataset to a CSV file
-twit_arc.to_csv('twitter_archive_master.csv', index=False)
+twit_arc.to_csv(os.path.join(data_dir, 'twitter_archive_master.csv'), index=False)
 twit_arc
 
 
+# In[ ]:
+
+
+# Also saving it as an Arrow IPC file, which the analysis (or any other process) can memory-map without parsing or copying
+master_table = pa.Table.from_pandas(twit_arc, preserve_index=False)
+
+with pa.OSFile(os.path.join(data_dir, 'twitter_archive_master.arrow'), 'wb') as sink:
+    with pa.ipc.new_file(sink, master_table.schema) as writer:
+        writer.write_table(master_table)
+
+
 # ## Analyzing and Visualizing Data
 # In this section, I will analyze and visualize the wrangled data.
 
@@ -676,17 +1328,20 @@ twit_arc
 # 
 # #### Code
 
-# In[36]:
+# In[ ]:
 
 
 import matplotlib.pyplot as plt
 import seaborn as sns
 
 get_ipython().run_line_magic('matplotlib', 'inline')
+
+# Reading the master dataset from the Arrow file: the columns point to the memory-mapped buffers
+twit_arc = pa.ipc.open_file(pa.memory_map(os.path.join(data_dir, 'twitter_archive_master.arrow'))).read_all().to_pandas(types_mapper=pd.ArrowDtype)
 print(twit_arc.columns) #to check if there's no error in the merge of the dataframes
 
 
-# In[37]:
+# In[ ]:
 
 
 # Getting the counts of each breed prediction
@@ -707,7 +1362,7 @@ print(top_5_breeds)
 
 # ### Visualization
 
-# In[45]:
+# In[ ]:
 
 
 # Creating a bar chart of the top 5 most popular breeds
@@ -729,7 +1384,7 @@ plt.show()
 # 
 # #### Code
 
-# In[39]:
+# In[ ]:
 
 
 # Get the counts of each dog name
@@ -743,7 +1398,7 @@ print("The 4th most common dog name is:", name_counts.index[3])
 print("The 5th most common dog name is:", name_counts.index[4])
 
 
-# In[73]:
+# In[ ]:
 
 
 name_counts
@@ -751,14 +1406,14 @@ name_counts
 
 # ### Insights
 
-# > - A very high number of 726 have no dog name. Possibly were not properly recorded. 
+# > - A very high number of 582 have no dog name. Possibly were not properly recorded. 
 # > - For female & male dogs: Lucy and Charlie are the most popular names.
-# > - After None, 11 names can be place on the top 5 most common names, since their qualification matches (no difference of number of name, or only 1 name difference)
+# > - After None, the counts are very close: Charlie (11), Cooper and Lucy (10), Penny, Oliver and Tucker (9), so no single name clearly leads.
 # 
 
 # ### Visualization
 
-# In[82]:
+# In[ ]:
 
 
 # Defining fun colors
@@ -770,7 +1425,7 @@ plt.title("Most Popular Dog Names", size = 20)
 plt.pie(popular_name, labels = popular_name.index, colors = colors, autopct='%1.1f%%', textprops={'fontsize': 13});
 
 
-# In[83]:
+# In[ ]:
 
 
 #checking with and without the None names:
@@ -798,7 +1453,7 @@ plt.show()
 # 
 # #### Code
 
-# In[49]:
+# In[ ]:
 
 
 # Geting the counts of each rating
@@ -813,12 +1468,12 @@ print("The most common rating is:", most_common_rating)
 
 # ### Insights
 
-# > - The most popular rating is 10/10, 12/10, and 11/10. 
+# > - The most popular rating is 12/10, 10/10, and 11/10. 
 # > - It was found that *WeRateDogs* tend to give high ratings to most of the dogs they post.
 
 # ### Visualization
 
-# In[58]:
+# In[ ]:
 
 
 frequent_rating = twit_arc.ratings.value_counts()[:10]
@@ -837,3 +1492,259 @@ for index, value in enumerate(frequent_rating):
     
 plt.show()
 
+
+# ### 4) Engagement over time
+# 
+# > Questions like "engagement by week" or "rating trend by month" need a scan and a groupby of the whole master dataset each time. Instead, I will build an **engagement index**: the sums of tweets, retweets, favorites and ratings, pre-rolled in monthly, weekly (Monday to Sunday) and daily buckets per breed and dog stage. 
+# > A time range is then answered by adding up the biggest buckets which fit in it (months, then weeks, then days). Only the pieces of the range shorter than a day are read from the rows themselves.
+# 
+# #### Code
+
+# In[ ]:
+
+
+engagement_measures = ['tweets', 'retweet_count', 'favorite_count', 'rating_numerator', 'rating_denominator']
+bucket_freqs = {'month': 'M', 'week': 'W', 'day': 'D'}
+
+
+def build_engagement_index(dataset):
+    rows = pd.DataFrame({'timestamp': dataset.timestamp.astype('datetime64[ns]'),
+                         'breed': dataset.dog_predict.astype(arrow_str).fillna('None'),
+                         'dog_stage': dataset.dog_stage.astype(arrow_str),
+                         'tweets': 1,
+                         'retweet_count': dataset.retweet_count.astype(int),
+                         'favorite_count': dataset.favorite_count.astype(int),
+                         'rating_numerator': dataset.rating_numerator.astype(int),
+                         'rating_denominator': dataset.rating_denominator.astype(int)})
+    index = {}
+    for bucket, freq in bucket_freqs.items():
+        bucket_start = rows.timestamp.dt.to_period(freq).dt.start_time.rename('start')
+        index[bucket] = rows.groupby([bucket_start, 'breed', 'dog_stage'])[engagement_measures].sum()
+    # the rows sorted by time, for the pieces of a range shorter than a day
+    index['rows'] = rows.sort_values('timestamp', ignore_index=True)
+    return index
+
+
+def cover_range(start, end):
+    # splits [start, end) into the biggest aligned buckets, plus the pieces shorter than a day at the edges
+    buckets = {bucket: [] for bucket in bucket_freqs}
+    pieces = []
+    cursor = start
+    if cursor != cursor.normalize():
+        pieces.append((cursor, min(cursor.normalize() + pd.Timedelta(days=1), end)))
+        cursor = pieces[-1][1]
+    while cursor < end:
+        next_month = cursor + pd.offsets.MonthBegin(1)
+        next_day = cursor + pd.Timedelta(days=1)
+        if cursor.day == 1 and next_month <= end:
+            buckets['month'].append(cursor)
+            cursor = next_month
+        elif cursor.dayofweek == 0 and cursor + pd.Timedelta(days=7) <= end:
+            buckets['week'].append(cursor)
+            cursor = cursor + pd.Timedelta(days=7)
+        elif next_day <= end:
+            buckets['day'].append(cursor)
+            cursor = next_day
+        else:
+            pieces.append((cursor, end))
+            cursor = end
+    return buckets, pieces
+
+
+def query_engagement(index, start, end, breed=None, dog_stage=None, by=None):
+    # totals of the tweets posted in [start, end), optionally for one breed / dog stage, or per breed / dog stage (by)
+    buckets, pieces = cover_range(pd.Timestamp(start), pd.Timestamp(end))
+    parts = []
+    for bucket, starts in buckets.items():
+        table = index[bucket]
+        parts.append(table[table.index.get_level_values('start').isin(starts)].reset_index())
+    rows = index['rows']
+    for low, high in pieces:
+        parts.append(rows.iloc[rows.timestamp.searchsorted(low):rows.timestamp.searchsorted(high)])
+    selected = pd.concat(parts, ignore_index=True)
+
+    if breed is not None:
+        selected = selected[selected.breed == breed]
+    if dog_stage is not None:
+        selected = selected[selected.dog_stage == dog_stage]
+    if by is not None:
+        return selected.groupby(by)[engagement_measures].sum()
+    return selected[engagement_measures].sum()
+
+
+# In[ ]:
+
+
+engagement_index = build_engagement_index(twit_arc)
+
+# Engagement of the golden retrievers during the first half of 2016, and per dog stage during the summer of 2017
+print(query_engagement(engagement_index, '2016-01-01', '2016-07-01', breed='Golden_retriever'))
+query_engagement(engagement_index, '2017-06-15 12:00', '2017-08-01', by='dog_stage')
+
+
+# #### Test
+
+# In[ ]:
+
+
+# same result as a full scan of the dataset
+in_range = (twit_arc.timestamp >= pd.Timestamp('2017-06-15 12:00')) & (twit_arc.timestamp < pd.Timestamp('2017-08-01'))
+twit_arc[in_range].groupby('dog_stage')[['retweet_count', 'favorite_count']].sum()
+
+
+# ## Auditing Tweet Text
+# 
+# > The ratings and names were fixed by reading the *text* column with query() and str.contains(), which scans the whole dataset for every check. To audit them faster, I will build an **inverted index** of the cleaned text: for each word (and each rating fraction, like "13/10"), the tweet ids and positions where it appears. 
+# > The index is saved in a JSON file and updated incrementally: only the new tweets, or the tweets whose text changed, are tokenized again. It answers term and phrase queries directly, and regex queries are only checked on the tweets selected by the index first.
+
+# In[ ]:
+
+
+import re
+from collections import defaultdict
+
+text_index_path = os.path.join(data_dir, 'text_index.json')
+word_pattern = re.compile(r'\w+')
+# the fractions are found at every position, independently of the words (a lookahead doesn't consume the text):
+# "abc13/15" gives the fractions 13/15 and 3/15, and "13/10/15" gives 13/10, 3/10, 10/15 and 0/15,
+# so a regex on the ratings always finds its match among the indexed fractions
+fraction_pattern = re.compile(r'(?=(\d+(?:\.\d+)?/\d+))')
+
+
+def tokenize(text):
+    tokens = [(match.start(), -len(match.group()), match.group().lower()) for match in word_pattern.finditer(text)]
+    tokens += [(match.start(), -len(match.group(1)), match.group(1)) for match in fraction_pattern.finditer(text)]
+    # in order of appearance (the longest first when two tokens start at the same place)
+    return [token for _, _, token in sorted(tokens)]
+
+
+def load_text_index(path=text_index_path):
+    # docs: tweet_id -> text, postings: token -> {tweet_id: [positions]}
+    if os.path.exists(path):
+        with open(path) as file:
+            return json.load(file)
+    return {'docs': {}, 'postings': {}}
+
+
+def save_text_index(index, path=text_index_path):
+    with open(path, 'w') as outfile:
+        json.dump(index, outfile)
+
+
+def remove_from_text_index(index, tweet_id):
+    docs, postings = index['docs'], index['postings']
+    for token in set(tokenize(docs.pop(tweet_id))):
+        del postings[token][tweet_id]
+        if not postings[token]:
+            del postings[token]
+
+
+def update_text_index(index, tweet_ids, texts):
+    # tweet_ids and texts are the whole dataset: the new or changed tweets are (re-)indexed,
+    # and the tweets which are not in the dataset any more are removed
+    docs, postings = index['docs'], index['postings']
+    tweet_ids = [str(tweet_id) for tweet_id in tweet_ids]
+    removed = set(docs) - set(tweet_ids)
+    for tweet_id in removed:
+        remove_from_text_index(index, tweet_id)
+
+    updated = 0
+    for tweet_id, text in zip(tweet_ids, texts):
+        if docs.get(tweet_id) == text:
+            continue
+        # the text changed: removing the old postings first
+        if tweet_id in docs:
+            remove_from_text_index(index, tweet_id)
+        positions = defaultdict(list)
+        for position, token in enumerate(tokenize(text)):
+            positions[token].append(position)
+        for token, token_positions in positions.items():
+            postings.setdefault(token, {})[tweet_id] = token_positions
+        docs[tweet_id] = text
+        updated += 1
+    return updated, len(removed)
+
+
+def search_term(index, term):
+    return sorted(index['postings'].get(term.lower(), {}))
+
+
+def search_phrase(index, phrase):
+    tokens = tokenize(phrase)
+    postings = [index['postings'].get(token, {}) for token in tokens]
+    # the tweets with all the words, then keeping the ones where the words follow each other
+    candidates = set.intersection(*[set(posting) for posting in postings]) if postings else set()
+    found = []
+    for tweet_id in candidates:
+        starts = set(postings[0][tweet_id])
+        for offset, posting in enumerate(postings[1:], start=1):
+            starts &= {position - offset for position in posting[tweet_id]}
+        if starts:
+            found.append(tweet_id)
+    return sorted(found)
+
+
+def search_regex(index, pattern, term_pattern=None, phrase=None):
+    # Prefilter: the tweets with a word matching term_pattern (checked on the vocabulary, not on the texts)
+    # and/or containing the phrase. The regex is then only run on those texts.
+    # Returns the first match of each tweet, indexed by tweet_id.
+    candidates = None
+    if term_pattern is not None:
+        term_regex = re.compile(term_pattern)
+        candidates = {tweet_id for token, posting in index['postings'].items()
+                      if term_regex.fullmatch(token) for tweet_id in posting}
+    if phrase is not None:
+        phrase_ids = set(search_phrase(index, phrase))
+        candidates = phrase_ids if candidates is None else candidates & phrase_ids
+    if candidates is None:
+        candidates = index['docs']
+
+    regex = re.compile(pattern)
+    matches = {}
+    for tweet_id in sorted(candidates):
+        match = regex.search(index['docs'][tweet_id])
+        if match:
+            matches[tweet_id] = match.group(0)
+    return pd.Series(matches, dtype=arrow_str, name='match').rename_axis('tweet_id')
+
+
+# In[ ]:
+
+
+text_index = load_text_index()
+start = timer()
+updated, removed = update_text_index(text_index, twit_arc.tweet_id, twit_arc.text)
+print(updated, 'tweets indexed,', removed, 'removed')
+save_text_index(text_index)
+end = timer()
+print(end - start)
+
+
+# In[ ]:
+
+
+# ratings whose denominator is not 10
+start = timer()
+odd_ratings = search_regex(text_index, r'\d+(?:\.\d+)?/(?!10(?!\d))\d+', term_pattern=r'\d+(?:\.\d+)?/(?!10$)\d+')
+end = timer()
+print(end - start)
+odd_ratings
+
+
+# In[ ]:
+
+
+# names written as "This is <Name>"
+names_in_text = search_regex(text_index, r'This is ([A-Z][a-z]+)', phrase='this is')
+names_in_text.str.replace('This is ', '').value_counts().head(10)
+
+
+# #### Test
+
+# In[ ]:
+
+
+# same tweets as scanning the whole text column (with Python's re: Arrow's regex engine has no lookahead)
+print(sorted(twit_arc[twit_arc.text.astype(object).str.contains(r'\d+(?:\.\d+)?/(?!10(?!\d))\d+', regex=True)].tweet_id) == list(odd_ratings.index))
+print(search_term(text_index, 'doggo') == sorted(twit_arc[twit_arc.text.str.contains(r'\bdoggo\b', case=False, regex=True)].tweet_id))
+